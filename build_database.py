@@ -1,9 +1,40 @@
-import gzip
+import asyncio
+import aiohttp
 import pandas as pd
-import requests
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pyarrow import compute as pa_compute
 import logging
+import re
+import shelve
 import sqlite3
 import datetime
+import time
+from contextlib import closing
+
+# Cap on simultaneous requests to the cocktails API
+MAX_CONCURRENT_REQUESTS = 20
+
+# On-disk cache of cocktails API responses, refreshed once a day
+COCKTAIL_CACHE_PATH = "data/cocktail_cache"
+COCKTAIL_CACHE_TTL = 86400
+
+# Multi-row INSERT batch size, bounded by SQLite's limit on bound variables
+INSERT_CHUNKSIZE = 10000
+SQLITE_MAX_VARIABLES = 32766
+
+# Columns of the sales files, the first being an unnamed row number
+SALES_FILE_COLUMNS = ["rowID", "dateOfSale", "drink", "price"]
+SALES_COLUMN_TYPES = {
+    "dateOfSale": pa.timestamp("s"),
+    "drink": pa.dictionary(pa.int32(), pa.string()),
+    "price": pa.float64(),
+}
+# New York records dates as month-day-year
+SALES_DATE_FORMATS = [pa_csv.ISO8601, "%m-%d-%Y %H:%M"]
+
+# Glass count within free-text stock values, e.g. "34 glasses"
+STOCK_PATTERN = re.compile(r"(\d+)")
 
 
 def setup_logging():
@@ -25,51 +56,114 @@ def setup_logging():
     logger.addHandler(file_handler)
 
 
-def get_cocktail_data(drink):
+async def get_cocktail_data(session, semaphore, cache, drink):
+    # Return cached response if it is still fresh, only JSON objects are cached
+    cached = cache.get(drink)
+    if (
+        cached
+        and isinstance(cached["data"], dict)
+        and cached["ts"] > time.time() - COCKTAIL_CACHE_TTL
+    ):
+        return cached["data"]
+
     try:
         url = f"https://www.thecocktaildb.com/api/json/v1/1/search.php?s={drink}"
-        response = requests.get(url)
-
-        # Error capture
-        if response.status_code != 200:
-            logging.error(
-                f"Error getting cocktail data for {drink}: {response.status_code}"
-            )
-            return pd.DataFrame()
-
-        df = pd.DataFrame(response.json()["drinks"])
+        async with semaphore, session.get(url) as response:
+            # Error capture
+            if response.status != 200:
+                logging.error(
+                    f"Error getting cocktail data for {drink}: {response.status}"
+                )
+                return {}
+
+            data = await response.json(content_type=None)
+            # Empty body or a JSON null comes back as None
+            if not isinstance(data, dict):
+                logging.error(f"Unexpected cocktail data for {drink}: {data!r}")
+                return {}
+
+            cache[drink] = {"ts": time.time(), "data": data}
 
     except Exception as e:
         logging.error(f"Error getting cocktail data for {drink}: {e}")
-        df = pd.DataFrame()
+        data = {}
+
+    return data
+
+
+async def get_all_cocktail_data(drinks):
+    # Semaphore created inside the running event loop
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=300)
+    with shelve.open(COCKTAIL_CACHE_PATH) as cache:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(
+                *[
+                    get_cocktail_data(session, semaphore, cache, drink)
+                    for drink in drinks
+                ]
+            )
+
 
+def lowercase_strings(df, columns):
+    # Lower-case the given text columns with vectorised str methods
+    for col in columns:
+        df[col] = df[col].str.lower()
     return df
 
 
-def execute_sql_script(sql_script_string, db_name):
+def execute_sql_script(sql_script_string, conn):
     try:
-        with sqlite3.connect(db_name) as conn:
-            cursor = conn.cursor()
-            cursor.executescript(sql_script_string)
-            conn.commit()
+        cursor = conn.cursor()
+        cursor.executescript(sql_script_string)
+        conn.commit()
         logging.info("Execute SQL script complete.")
+        return True
     except Exception as e:
-        logging.error("SQL script failed to execute", e)
+        logging.error(f"SQL script failed to execute: {e}")
+        return False
 
 
-def execute_external_sql_script_file(script_file_path, db_name):
+def execute_external_sql_script_file(script_file_path, conn):
     with open(script_file_path, "r") as file:
         sql_script_string = file.read()
-    execute_sql_script(sql_script_string, db_name)
+    return execute_sql_script(sql_script_string, conn)
+
+
+def create_tables(conn):
+    return execute_external_sql_script_file("database/data_tables.sql", conn)
+
+
+def create_poc_tables(conn):
+    return execute_external_sql_script_file("database/poc_tables.sql", conn)
+
+
+def set_bulk_load_pragmas(conn):
+    # Trade durability for write throughput while the inserts run
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-200000")
 
 
-def create_tables(db_name):
-    execute_external_sql_script_file("database/data_tables.sql", db_name)
+def reset_pragmas(conn):
+    # Restore SQLite defaults so later writes are journalled and synced again
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA temp_store=DEFAULT")
+    conn.execute("PRAGMA cache_size=-2000")
 
 
-def insert_data_into_table(df, table_name, db_name):
-    with sqlite3.connect(db_name) as conn:
-        df.to_sql(table_name, conn, if_exists="append", index=False)
+def insert_data_into_table(df, table_name, conn):
+    chunksize = min(INSERT_CHUNKSIZE, SQLITE_MAX_VARIABLES // len(df.columns))
+    df.to_sql(
+        table_name,
+        conn,
+        if_exists="append",
+        index=False,
+        method="multi",
+        chunksize=chunksize,
+    )
     logging.info(f"Data inserted into {table_name} table.")
 
 
@@ -83,77 +177,74 @@ def process_bar_data():
         .rename(columns={"index": "stockID", "glass_type": "glassType"})
         .set_index("stockID")
     )
-    bar_stock_df["stock"] = bar_stock_df["stock"].str.extract("(\d+)", expand=False)
-    bar_stock_df["stock"] = bar_stock_df["stock"].astype(int)
-    bar_stock_df = bar_stock_df.applymap(
-        lambda s: s.lower() if isinstance(s, str) else s
-    )
+    # Nullable integers so a stock value without a number becomes missing
+    bar_stock_df["stock"] = pd.to_numeric(
+        bar_stock_df["stock"].str.extract(STOCK_PATTERN, expand=False)
+    ).astype("Int32")
+    bar_stock_df = lowercase_strings(bar_stock_df, ["glassType", "bar"])
 
     return bar_stock_df
 
 
+def read_sales_data(file_path, cutoff, skip_rows=0, delimiter=","):
+    # pyarrow decompresses and parses the gzipped file on multiple threads
+    table = pa_csv.read_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(
+            column_names=SALES_FILE_COLUMNS, skip_rows=skip_rows
+        ),
+        parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(SALES_COLUMN_TYPES),
+            column_types=SALES_COLUMN_TYPES,
+            timestamp_parsers=SALES_DATE_FORMATS,
+        ),
+    )
+
+    # Only sales made after the cutoff date are converted to pandas
+    cutoff = pa.scalar(
+        pd.Timestamp(cutoff).to_pydatetime(), type=SALES_COLUMN_TYPES["dateOfSale"]
+    )
+    return table.filter(pa_compute.greater(table["dateOfSale"], cutoff)).to_pandas()
+
+
 def process_sales_data():
     # create dicts of dates from text file for date filtering prior to upload
-    date_dict = {}
     with open("last_update.txt") as f:
-        for line in f:
-            k, v = line.split(" ", 1)
-            v = v[:-1]
-            date_dict[k] = v
+        date_dict = dict(line.rstrip("\n").split(" ", 1) for line in f if line.strip())
 
     # Import budapest data
-    budapest_df = pd.read_csv(
+    budapest_df = read_sales_data(
         "data/budapest.csv.gz",
-        compression="gzip",
-        header=0,
-        sep=",",
-        names=col_names,
-        parse_dates=["dateOfSale"],
+        date_dict.get("BUDA_date_max", "1900-01-01"),
+        skip_rows=1,
     )
     budapest_df["bar"] = "budapest"
-    budapest_df = budapest_df.loc[
-        budapest_df["dateOfSale"] > date_dict.get("BUDA_date_max", "1900-01-01")
-    ]
-    budapest_max_date = str(budapest_df.dateOfSale.max())
 
     # Import london data
-    london_df = pd.read_csv(
+    london_df = read_sales_data(
         "data/london_transactions.csv.gz",
-        compression="gzip",
-        header=None,
-        sep="\t",
-        names=col_names,
-        parse_dates=["dateOfSale"],
+        date_dict.get("LON_date_max", "1900-01-01"),
+        delimiter="\t",
     )
     london_df["bar"] = "london"
-    london_df = london_df.loc[
-        london_df["dateOfSale"] > date_dict.get("LON_date_max", "1900-01-01")
-    ]
-    london_max_date = str(london_df.dateOfSale.max())
 
     # Import new york data
-    new_york_df = pd.read_csv(
+    new_york_df = read_sales_data(
         "data/ny.csv.gz",
-        compression="gzip",
-        header=0,
-        sep=",",
-        names=col_names,
-        parse_dates=["dateOfSale"],
+        date_dict.get("NYC_date_max", "1900-01-01"),
+        skip_rows=1,
     )
     new_york_df["bar"] = "new york"
-    new_york_df = new_york_df.loc[
-        new_york_df["dateOfSale"] > date_dict.get("NYC_date_max", "1900-01-01")
-    ]
-    ny_max_date = str(new_york_df.dateOfSale.max())
-
-    # Set new dates to limit the size of future uploads
-    date_dict.update(
-        {
-            "NYC_date_max": ny_max_date,
-            "LON_date_max": london_max_date,
-            "BUDA_date_max": budapest_max_date,
-        }
-    )
+
+    # Set new dates to limit the size of future uploads, a bar with no new
+    # sales keeps its previous date
+    max_dates = {
+        "NYC_date_max": new_york_df.dateOfSale.max(),
+        "LON_date_max": london_df.dateOfSale.max(),
+        "BUDA_date_max": budapest_df.dateOfSale.max(),
+    }
+    date_dict.update({k: str(v) for k, v in max_dates.items() if pd.notna(v)})
     with open("last_update.txt", "w") as f:
         for k, v in date_dict.items():
             f.write(f"{k} {v}\n")
@@ -161,64 +252,53 @@ def process_sales_data():
     # Concatenate dataframes
     global_df = pd.concat([budapest_df, london_df, new_york_df], ignore_index=True)
     # Minor cleaning
-    global_df = (
-        global_df.reset_index().rename(columns={"index": "saleID"}).set_index("saleID")
-    )
-    global_df["price"] = global_df["price"].astype(float)
-    global_df = global_df.applymap(lambda s: s.lower() if isinstance(s, str) else s)
+    global_df = lowercase_strings(global_df, ["drink", "bar"])
+    global_df["drink"] = global_df["drink"].astype("category")
 
     return global_df
 
 
-def query_cocktail_data():
-    # Get drinks to query API
-    master_drinks = list(
-        set(
-            london_df.drink.unique().tolist()
-            + new_york_df.drink.unique().tolist()
-            + budapest_df.drink.unique().tolist()
-        )
-    )
+def query_cocktail_data(global_df):
+    # Get drinks to query API, the categories are the unique drinks sold
+    master_drinks = global_df["drink"].cat.categories.tolist()
+
+    # Query the API concurrently for all drinks
+    responses = asyncio.run(get_all_cocktail_data(master_drinks))
 
-    dfs = []
-    for counter, drink in enumerate(master_drinks, start=1):
-        # Extract data from the offset value
-        df = get_cocktail_data(drink)
-        df = df[
-            [
-                "idDrink",
-                "strDrink",
-                "strCategory",
-                "strIBA",
-                "strAlcoholic",
-                "strGlass",
-                "dateModified",
-            ]
-        ]
-        # Append data
-        dfs.append(df)
+    # Collect drink records from every response, no match returns None
+    records = []
+    for counter, data in enumerate(responses, start=1):
+        records.extend(data.get("drinks") or [])
         # Logging info output to see status
         logging.info(f"Current loop number: {counter} out of {len(master_drinks)}")
 
-    # Combine dataframes
-    cocktails_df = pd.concat(dfs, ignore_index=True)
-
-    # Minor cleaning
-    cocktails_df = cocktails_df.sort_values(by="dateModified", ascending=False)
-    cocktails_df["dateModified"] = pd.to_datetime(cocktails_df["dateModified"])
-    cocktails_df = cocktails_df.drop_duplicates(
-        subset=[
+    # Build dataframe once from all records
+    cocktails_df = pd.DataFrame(
+        records,
+        columns=[
             "idDrink",
             "strDrink",
             "strCategory",
             "strIBA",
             "strAlcoholic",
             "strGlass",
+            "dateModified",
         ],
-        keep="first",
     )
-    cocktails_df = cocktails_df.applymap(
-        lambda s: s.lower() if isinstance(s, str) else s
+
+    # Minor cleaning, keeping the latest version of each drink
+    cocktails_df["dateModified"] = pd.to_datetime(
+        cocktails_df["dateModified"],
+        format="%Y-%m-%d %H:%M:%S",
+        cache=True,
+        errors="coerce",
+    )
+    cocktails_df = cocktails_df.sort_values(
+        by="dateModified", ascending=False
+    ).drop_duplicates(subset="idDrink", keep="first")
+    cocktails_df = lowercase_strings(
+        cocktails_df,
+        ["strDrink", "strCategory", "strIBA", "strAlcoholic", "strGlass"],
     )
 
     return cocktails_df
@@ -229,28 +309,40 @@ def main():
     # Initialize logging
     setup_logging()
 
-    # Create tables in the SQLite database
+    # One connection for the whole build
     db_name = "database/bar_db"
-    create_tables(db_name)
-    logging.info("Tables created in the SQLite database.")
-
-    # Read and process bar data
-    bar_stock_df = process_bar_data()
-    logging.info("Bar data processed successfully.")
-
-    # Read and process sales data
-    global_df = process_sales_data()
-    logging.info("Sales data processed successfully.")
-
-    # Query cocktail data
-    cocktails_df = query_cocktail_data()
-    logging.info("Cocktail data queried successfully.")
-
-    # Insert data into respective tables
-    insert_data_into_table(global_df, "global_sales", db_name)
-    insert_data_into_table(bar_stock_df, "bar_stock", db_name)
-    insert_data_into_table(cocktails_df, "cocktails", db_name)
-    logging.info("Data inserted into respective tables.")
+    with closing(sqlite3.connect(db_name)) as conn:
+        # Create tables in the SQLite database
+        if create_tables(conn):
+            logging.info("Tables created in the SQLite database.")
+
+        # Read and process bar data
+        bar_stock_df = process_bar_data()
+        logging.info("Bar data processed successfully.")
+
+        # Read and process sales data
+        global_df = process_sales_data()
+        logging.info("Sales data processed successfully.")
+
+        # Query cocktail data
+        cocktails_df = query_cocktail_data(global_df)
+        logging.info("Cocktail data queried successfully.")
+
+        # Insert data into respective tables, pandas writes all batches for a
+        # table in one transaction and commits at the end of each to_sql call.
+        # Fast-write PRAGMAs only apply to this phase.
+        set_bulk_load_pragmas(conn)
+        try:
+            insert_data_into_table(global_df, "global_sales", conn)
+            insert_data_into_table(bar_stock_df, "bar_stock", conn)
+            insert_data_into_table(cocktails_df, "cocktails", conn)
+        finally:
+            reset_pragmas(conn)
+        logging.info("Data inserted into respective tables.")
+
+        # Create proof of concept table for bar staff
+        if create_poc_tables(conn):
+            logging.info("PoC tables created in the SQLite database.")
 
 
 if __name__ == "__main__":
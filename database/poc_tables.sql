@@ -1,5 +1,8 @@
 -- This is where you will write the SQL to create the tables needed by the bar staff to assist on restocking decisions
 
+-- rebuild on every run so the table reflects newly loaded sales
+DROP TABLE IF EXISTS poc_analysis;
+
 CREATE TABLE poc_analysis AS
 
 -- create table grouped on day level with glass for cocktail obtained from cocktail table